@@ -1,14 +1,47 @@
 import random
+import gzip
 import csv
-from io import StringIO
-import types
+from io import StringIO, BytesIO
 import json
+import hashlib
+import mimetypes
 import re
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import datetime
 import os
 import time
-import easy_s3
+from itertools import repeat
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_SESSION_LOCK = threading.Lock()
+
+
+def _create_client(service_name, **kwargs):
+    """
+    인스턴스마다 자격 증명을 다시 찾지 않도록 boto3 의 기본 세션을 공유해서 클라이언트를 만듭니다. 세션으로 클라이언트를 만드는 것은 스레드에 안전하지 않아 잠금을 걸고 만듭니다.
+    """
+    with _SESSION_LOCK:
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+
+        return boto3.DEFAULT_SESSION.client(service_name, **kwargs)
+
+
+def _splitext_fast(path):
+    """
+    S3 키는 항상 / 로 구분되므로 os.path.splitext 대신 rfind 로 확장자를 나눕니다. 파일 이름이 . 으로 시작하면 확장자로 보지 않습니다.
+    """
+    start = path.rfind("/") + 1
+    dot = path.rfind(".")
+    if dot <= start or (path[start] == "." and not path[start:dot].lstrip(".")):
+        return path, ""
+
+    return path[:dot], path[dot:]
+
 
 class DataWarehouse():
     """
@@ -42,9 +75,47 @@ class DataWarehouse():
         웨어하우스 이름입니다. 
 
         default/[warehouse_name]/... 와 같은 경로로 저장됩니다.
+
+    * max_pool_connections: int
+
+        S3, 아테나 클라이언트의 커넥션 풀 크기입니다. 여러 스레드로 동시에 요청 할 때 풀이 가득 차지 않도록 늘려줍니다.
+
+        생략하면 환경변수 BOTO_MAX_POOL_CONNECTIONS 를 사용하고, 환경변수도 없다면 50 을 사용합니다.
+
+    * list_cache_ttl: int | float (default = 0)
+
+        리스트 결과를 메모리에 캐시할 시간(초)입니다. 같은 경로를 반복해서 리스트 할 때 S3 요청을 줄여줍니다. 0 이면 캐시하지 않습니다.
+
+    * compress_type: str (default = "gz")
+
+        저장 할 때 사용할 압축 방식입니다. "gz", "gz1"(압축 레벨 1 의 빠른 gzip), "zstd" 를 사용 할 수 있습니다.
+
+        불러 올 때는 이 압축 방식의 확장자를 먼저 찾고, 없다면 다른 압축 방식으로 저장된 파일을 찾습니다.
+
+        "zstd" 를 사용하려면 `zstandard` 를 설치해야 합니다.
     
     """
-    def __init__(self, bucket_name, table_name="", aws_access_key_id=None, aws_secret_access_key=None, region_name=None, warehouse_name="warehouse"):
+
+    # compress_type 별로 저장 경로에 붙는 확장자
+    _COMPRESS_EXTS = {"gz": ".gz", "gz1": ".gz", "zstd": ".zst"}
+
+    # compress_type 별 S3 Content-Encoding
+    _CONTENT_ENCODINGS = {"gz": "gzip", "gz1": "gzip", "zstd": "zstd"}
+
+    # 이미 압축되어 있어 다시 압축하지 않고 그대로 저장하는 확장자
+    # .gz, .zst 는 불러올 때 압축을 풀기 때문에 그대로 저장하면 원본을 돌려받을 수 없어서 제외합니다.
+    _INCOMPRESSIBLE_EXTS = {".parquet", ".zip", ".bz2", ".xz", ".7z", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp3", ".mp4"}
+
+    # 이 크기보다 큰 파일은 _RANGED_GET_CHUNK 크기의 범위로 나눠서 동시에 받습니다.
+    _RANGED_GET_THRESHOLD = 32 * 1024 * 1024
+    _RANGED_GET_CHUNK = 8 * 1024 * 1024
+    # 모든 범위 요청이 공유하는 스레드 수입니다. 리스트하며 불러오는 스레드와 합쳐도 커넥션 풀을 넘지 않도록 합니다.
+    _RANGED_GET_WORKERS = 8
+
+    # default/[warehouse_name]/[store_kind]/[table_kind]/[meta_or_value]/... 에서 meta_or_value 앞까지
+    _META_PATH_RE = re.compile(r"^((?:[^/]*/){4})[^/]*")
+
+    def __init__(self, bucket_name, table_name="", aws_access_key_id=None, aws_secret_access_key=None, region_name=None, warehouse_name="warehouse", max_pool_connections=None, list_cache_ttl=0, compress_type="gz"):
 
         self.warehouse_name = warehouse_name
         self.bucket_name = bucket_name
@@ -52,17 +123,35 @@ class DataWarehouse():
         self._aws_access_key_id = aws_access_key_id
         self._aws_secret_access_key = aws_secret_access_key
         self._region_name = region_name
-        self._es_handler = easy_s3.EasyS3(bucket_name, self.warehouse_name, self._region_name, self._aws_access_key_id, self._aws_secret_access_key)
 
+        if compress_type not in self._COMPRESS_EXTS:
+            raise ValueError(f"invalid compress_type {compress_type}")
+        self._compress_type = compress_type
+
+        if max_pool_connections is None:
+            max_pool_connections = int(os.environ.get("BOTO_MAX_POOL_CONNECTIONS", 50))
+
+        self._max_pool_connections = max_pool_connections
+        self._boto_config = Config(max_pool_connections=max_pool_connections,
+                                   retries={"max_attempts": 10, "mode": "adaptive"})
+
+        self._client_lock = threading.Lock()
+        self._s3 = None
+        self._range_executor = None
         self._athena_client = None
 
+        self._list_cache_ttl = list_cache_ttl
+        self._list_cache = {}
+
 
     # 실제 사용하는 기능들
     def raw_save(self, user_path, value, meta={}, use_ymd=True, table_name="", table_kind="general", ymd=""):
         """
         * 만약 parquet 확장자로 저장하려면 `fastparquet` 와 `pandas` 를 설치해야 합니다.
 
-        * 기본적으로 gz 압축되어 저장됩니다.
+        * 기본적으로 gz 압축되어 저장됩니다. 핸들러를 만들 때 compress_type 으로 압축 방식을 바꿀 수 있습니다.
+
+        * png, jpg, zip 처럼 이미 압축된 확장자는 압축하지 않고 그대로 저장됩니다.
 
         `RAW 저장되는 경로`: raw_save 는 비정형 데이터를 저장 할 때 사용합니다. 저장되는 경로는 아래와 같습니다.
 
@@ -112,7 +201,9 @@ class DataWarehouse():
         """
         * 만약 parquet 확장자로 저장하려면 `fastparquet` 와 `pandas` 를 설치해야 합니다.
 
-        * 기본적으로 gz 압축되어 저장됩니다.
+        * 기본적으로 gz 압축되어 저장됩니다. 핸들러를 만들 때 compress_type 으로 압축 방식을 바꿀 수 있습니다.
+
+        * png, jpg, zip 처럼 이미 압축된 확장자는 압축하지 않고 그대로 저장됩니다.
 
         `DISCOVERY 저장되는 경로`: discovery_save 는 반정형, 정형 데이터를 저장 할 때 사용합니다. 저장되는 경로는 아래와 같습니다.
 
@@ -229,7 +320,7 @@ class DataWarehouse():
         return self._load_worker("discovery", table_name, user_path, table_kind, ymd, is_meta)
         
 
-    def raw_list(self, table_name="", user_dir="", ymd="", table_kind="general", load=False, is_meta=False, includes=[], is_direoctry=False):
+    def raw_list(self, table_name="", user_dir="", ymd="", table_kind="general", load=False, is_meta=False, includes=[], is_direoctry=False, use_index_cache=False, index_cache_ttl=3600):
         """
         `RAW 리스트하는 경로`: raw_load 는 비정형 데이터를 리스트 할 때 사용합니다. 리스트하는 경로는 아래와 같습니다.
 
@@ -263,20 +354,34 @@ class DataWarehouse():
 
         * `is_direoctry`: bool (default = False)
 
-            파일이 아닌 디렉토리를 리스트 할 수 있습니다.
+            파일이 아닌 디렉토리를 리스트 할 수 있습니다. 리스트하는 경로 바로 아래의 디렉토리만 리스트합니다.
 
         * `includes`: str list 
 
             리스트를 이 매개변수에 포함된 값으로 필터합니다.
 
+        * `use_index_cache`: bool (default = False)
+
+            리스트 결과를 S3 에 인덱스 파일로 저장해두고, 다음에 같은 경로를 리스트 할 때 인덱스 파일을 불러옵니다. 파일이 아주 많은 경로를 반복해서 리스트 할 때 사용합니다.
+
+        * `index_cache_ttl`: int (default = 3600)
+
+            인덱스 파일을 사용할 시간(초)입니다. 이 시간이 지나면 다시 리스트합니다.
+
 
         **Returns**
 
         * `리스트 결과`: list
+
+            * load=False: `[{"Key": str, "Size": int, "LastModified": datetime}, ...]`
+
+            * load=True: `[{"key": str, "value": 불러온 데이터}, ...]`
+
+            * is_direoctry=True: `[디렉토리 경로: str, ...]`
         """          
-        return self._list_worker("raw", table_kind, table_name, user_dir, ymd, load, is_meta, includes, is_direoctry)
+        return self._list_worker("raw", table_kind, table_name, user_dir, ymd, load, is_meta, includes, is_direoctry, use_index_cache, index_cache_ttl)
 
-    def discovery_list(self, table_name="", user_dir="", ymd="", table_kind="general", load=False, is_meta=False, includes=[], is_direoctry=False):
+    def discovery_list(self, table_name="", user_dir="", ymd="", table_kind="general", load=False, is_meta=False, includes=[], is_direoctry=False, use_index_cache=False, index_cache_ttl=3600):
         """
         `DISCOVERY 리스트하는 경로`: discovery_load 는 반정형, 정형 데이터를 리스트 할 때 사용합니다. 리스트하는 경로는 아래와 같습니다.
 
@@ -310,18 +415,32 @@ class DataWarehouse():
 
         * `is_direoctry`: bool (default = False)
 
-            파일이 아닌 디렉토리를 리스트 할 수 있습니다.
+            파일이 아닌 디렉토리를 리스트 할 수 있습니다. 리스트하는 경로 바로 아래의 디렉토리만 리스트합니다.
 
         * `includes`: str list 
 
             리스트를 이 매개변수에 포함된 값으로 필터합니다.
 
+        * `use_index_cache`: bool (default = False)
+
+            리스트 결과를 S3 에 인덱스 파일로 저장해두고, 다음에 같은 경로를 리스트 할 때 인덱스 파일을 불러옵니다. 파일이 아주 많은 경로를 반복해서 리스트 할 때 사용합니다.
+
+        * `index_cache_ttl`: int (default = 3600)
+
+            인덱스 파일을 사용할 시간(초)입니다. 이 시간이 지나면 다시 리스트합니다.
+
 
         **Returns**
 
         * `리스트 결과`: list
+
+            * load=False: `[{"Key": str, "Size": int, "LastModified": datetime}, ...]`
+
+            * load=True: `[{"key": str, "value": 불러온 데이터}, ...]`
+
+            * is_direoctry=True: `[디렉토리 경로: str, ...]`
         """           
-        return self._list_worker("discovery", table_kind, table_name, user_dir, ymd, load, is_meta, includes, is_direoctry)
+        return self._list_worker("discovery", table_kind, table_name, user_dir, ymd, load, is_meta, includes, is_direoctry, use_index_cache, index_cache_ttl)
 
     def load_with_full_path(self, full_path):
         """
@@ -335,7 +454,7 @@ class DataWarehouse():
 
         * `불러온 데이터`: dict | list | str | ...        
         """
-        return self._es_handler._load_file(full_path)
+        return self._load_file(full_path)
 
     def load_meta_with_full_path(self, full_path):
         """
@@ -349,13 +468,15 @@ class DataWarehouse():
 
         * `불러온 메타 데이터`: dict        
         """
-        return self._es_handler._load_file(self._get_meta_path_with_full_path(full_path))
+        return self._load_file(self._get_meta_path_with_full_path(full_path))
 
     def _get_meta_path_with_full_path(self, full_path):
-        splited = full_path.split("/")
-        splited[4] = "meta"
+        meta_path, count = self._META_PATH_RE.subn(r"\1meta", full_path, count=1)
+        if count == 0:
+            raise ValueError(f"invalid full_path {full_path}")
+
+        return meta_path
 
-        return "/".join(splited)
     def load_with_athena_query(self, query, format_type="auto", request_limit=10000):
         """
         아테나로 데이터를 불러 올 때 사용합니다.
@@ -384,12 +505,10 @@ class DataWarehouse():
                 return "raw"
 
 
-        def get_var_char_values(d):
-            return [obj['VarCharValue'] for obj in d['Data']]
-
         def parse(header, rows):
-            header = get_var_char_values(header)
-            return [dict(zip(header, get_var_char_values(row))) for row in rows]
+            # NULL 인 칸은 VarCharValue 가 없으므로 None 으로 채웁니다.
+            values = [[obj.get('VarCharValue') for obj in row['Data']] for row in rows]
+            return list(map(dict, map(zip, repeat(header), values)))
 
         athena_client = self._get_athena_client()
         if format_type == "auto":
@@ -405,10 +524,10 @@ class DataWarehouse():
             }
         })["QueryExecutionId"]
 
+        delay = 0.1
         while True:
             status = athena_client.get_query_execution(QueryExecutionId=query_id)[
                 "QueryExecution"]["Status"]["State"]
-            time.sleep(1)
             if status == "CANCELLED":
                 raise ValueError(f"[{query}] is cancelled.")
 
@@ -417,97 +536,96 @@ class DataWarehouse():
 
             elif status == "SUCCEEDED":
                 break
-            else:
-                continue
+
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
         print("query complete")
         print("get query results ...")
-        next_tokens = []
-        header = []
-        for index in range(request_limit):
-            
-            request_data = {
-                "QueryExecutionId":query_id
-            }
-
-            if len(next_tokens):
-                request_data["NextToken"] = next_tokens[-1]
+        paginator = athena_client.get_paginator("get_query_results")
+        pages = paginator.paginate(QueryExecutionId=query_id, PaginationConfig={"PageSize": 1000})
+
+        if format_type == "raw":
+            result.append(next(iter(pages)))
+
+        elif format_type == "select":
+            # 현재 페이지를 파싱하는 동안 다음 페이지를 받아오도록 백그라운드 스레드에서 미리 받아둡니다.
+            page_queue = queue.Queue(maxsize=4)
+            stop_event = threading.Event()
+
+            def put_page(page):
+                # 파싱하는 쪽이 중간에 멈췄다면 큐가 비워지지 않으므로 기다리지 않고 끝냅니다.
+                while not stop_event.is_set():
+                    try:
+                        page_queue.put(page, timeout=0.1)
+                        return True
+                    except queue.Full:
+                        continue
+
+                return False
+
+            def fetch_pages():
+                try:
+                    for index, page in enumerate(pages):
+                        if index >= request_limit:
+                            break
+                        if not put_page(page):
+                            return
+                except Exception as e:
+                    put_page(e)
+                    return
+
+                put_page(None)
+
+            threading.Thread(target=fetch_pages, daemon=True).start()
+
+            header = None
+            index = 0
+            try:
+                while True:
+                    page = page_queue.get()
+                    if page is None:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
 
-            query_raw_result = athena_client.get_query_results(**request_data)
+                    rows = page['ResultSet']['Rows']
+                    if header is None:
+                        header, *rows = rows
+                        header = tuple(obj['VarCharValue'] for obj in header['Data'])
 
-            if format_type == "raw":
-                result.append(query_raw_result)
-                break
-            elif format_type == "select":
-                if index == 0:
-                    header, *rows = query_raw_result['ResultSet']['Rows']
-                else:
-                    rows = query_raw_result['ResultSet']['Rows']
-
-                result.extend(parse(header, rows))
-                
-                if "NextToken" in query_raw_result:
-                    new_next_token = query_raw_result["NextToken"]
+                    result.extend(parse(header, rows))
                     print(f"{index}", end=" ")
-                    if new_next_token not in next_tokens:
-                        next_tokens.append(new_next_token)
-                    else:
-                        break
-                else:
-                    break
+                    index += 1
+            finally:
+                stop_event.set()
 
         print("\nathena query complete")
         return result
 
 
     # TOOLS
-    def _parse_full_path(self, full_path):
-
-        is_gz = False
-        if full_path[-3:] == ".gz":
-            full_path = full_path[:-3]
-            is_gz = True
-
-        self._valid_full_path(full_path)
-
-        basename = os.path.basename(full_path)
-
-        _, ext = os.path.splitext(basename)
-        splited = full_path.split("/")
-
-        assert splited[0] == "default"
-        assert splited[1] == self.warehouse_name
-
-        store_kind = splited[3]
-        meta_or_value = splited[4]
-        table_name = splited[5]
-        ymd = splited[6]
-        # splited = uuid.split("_")
-        # time_ns = ""
-        # if len(splited) == 2:
-        #     time_ns, _ = splited
-
-        return types.SimpleNamespace(
-            full_path=full_path,
-            # time_ns=time_ns,
-            # uuid=uuid,
-            ext=ext,
-            store_kind=store_kind,
-            meta_or_value=meta_or_value,
-            table_name=table_name,
-            gz=is_gz,
-            ymd=ymd)
-
     def _load_worker(self, store_kind, table_name, user_path, table_kind, ymd="", is_meta=False):
         table_name = self._get_table_name(table_name)
         result = None
 
-        warehouse_full_path = self._get_warehouse_full_path(
-            store_kind, table_name, user_path, table_kind, ymd, is_meta)
-        result = self._es_handler.load(warehouse_full_path)
+        # compress_type 은 저장 할 때만 사용하므로, 다른 압축 방식으로 저장된 파일도 찾아서 불러옵니다.
+        error = None
+        for add_ext in self._get_load_exts(user_path):
+            warehouse_full_path = self._get_warehouse_full_path(
+                store_kind, table_name, user_path, table_kind, ymd, is_meta, add_ext=add_ext)
+            try:
+                result = self._load_file(f"default/{self.warehouse_name}/{warehouse_full_path}")
+            except ClientError as e:
+                if not self._is_missing_key_error(e):
+                    raise
+                if error == None:
+                    error = e
+            else:
+                return result
 
-        return result
+        raise error
 
-    def _list_worker(self, store_kind, table_kind, table_name="", user_dir="", ymd="", load=False, is_meta=False, includes=[], is_direoctry=False):
+    def _list_worker(self, store_kind, table_kind, table_name="", user_dir="", ymd="", load=False, is_meta=False, includes=[], is_direoctry=False, use_index_cache=False, index_cache_ttl=3600):
         result = None
         table_name = self._get_table_name(table_name)
         ymd_with_slash = ""
@@ -519,36 +637,244 @@ class DataWarehouse():
             ymd_with_slash = f"/{ymd}"
 
         full_path = f"{store_kind}/{table_kind}/value/{table_name}{user_dir_with_slash}{ymd_with_slash}"
-        objects = self._es_handler.list_objects(full_path, self.warehouse_name)
-        if len(includes) > 0:
-            temp = []
-            for obj in objects:
-                key = obj["Key"]
-                for include_str in includes:
-                    if key.find(include_str) != -1:
-                        temp.append(obj)
-
-            objects = temp
         if not is_direoctry:
-            objects = self._es_handler.list_objects(full_path, self.warehouse_name)        
+            objects = self._list_objects(full_path, use_index_cache, index_cache_ttl)
+            if len(includes) > 0:
+                include_pattern = re.compile("|".join(map(re.escape, includes)))
+                objects = [obj for obj in objects if include_pattern.search(obj["Key"])]
+
             if load == True:
-                result = []
-                for obj in objects:
-
-                    key = obj["Key"]
-                    if is_meta:
-                        value = self.load_meta_with_full_path(key)
-                    else:
-                        value = self.load_with_full_path(key)
-
-                    result.append({
-                        "key": key,
-                        "value": value
-                    })
+                keys = [obj["Key"] for obj in objects]
+                loader = self.load_meta_with_full_path if is_meta else self.load_with_full_path
+
+                # S3 GET 대기 시간이 대부분이므로 스레드로 동시에 불러옵니다. 모든 스레드가 같은 클라이언트를 공유하므로
+                # 범위 요청 스레드와 합쳐서 커넥션 풀보다 많이 만들지 않습니다.
+                max_workers = min(32, max(1, self._max_pool_connections - self._RANGED_GET_WORKERS))
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    values = list(executor.map(loader, keys))
+
+                result = [{
+                    "key": key,
+                    "value": value
+                } for key, value in zip(keys, values)]
             else:
                 result = objects
         else:
-            result = self._es_handler.listdir(full_path)
+            result = self._listdir(full_path)
+
+        return result
+
+    def _list_objects(self, full_path, use_index_cache=False, index_cache_ttl=3600):
+        """
+        list_cache_ttl 이 설정되어 있다면 캐시된 리스트 결과를 사용합니다.
+
+        use_index_cache 가 True 라면 S3 에 저장된 인덱스 파일을 먼저 불러오고, 없거나 만료되었다면 리스트한 뒤 인덱스 파일로 저장합니다.
+        """
+        now = time.monotonic()
+        if self._list_cache_ttl > 0:
+            cached = self._list_cache.get(full_path)
+            if cached is not None and now - cached[0] < self._list_cache_ttl:
+                return [dict(obj) for obj in cached[1]]
+
+        if use_index_cache:
+            index_path = f"default/{self.warehouse_name}/_index/{hashlib.sha1(full_path.encode('utf-8')).hexdigest()}.json.gz"
+            objects = self._load_list_index(index_path, index_cache_ttl)
+            if objects is None:
+                objects = self._list_s3_objects(full_path)
+                self._save_list_index(index_path, objects)
+        else:
+            objects = self._list_s3_objects(full_path)
+
+        if self._list_cache_ttl > 0:
+            # 돌려준 결과를 고쳐도 캐시가 바뀌지 않도록 복사해서 저장합니다.
+            self._list_cache[full_path] = (now, [dict(obj) for obj in objects])
+
+        return objects
+
+    def _invalidate_list_cache(self, warehouse_full_path):
+        """
+        저장한 파일이 포함되는 경로의 리스트 캐시를 지웁니다.
+        """
+        for full_path in list(self._list_cache):
+            if warehouse_full_path.startswith(f"{full_path}/"):
+                self._list_cache.pop(full_path, None)
+
+    def _list_s3_objects(self, full_path):
+        """
+        경로 아래의 파일을 list_objects_v2 로 모두 리스트합니다. 크기가 0 인 디렉토리 객체는 제외합니다.
+        """
+        paginator = self._s3_client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(Bucket=self.bucket_name, Prefix=f"default/{self.warehouse_name}/{full_path}/",
+                                   PaginationConfig={"PageSize": 1000})
+
+        return [{
+            "Key": obj["Key"],
+            "Size": obj["Size"],
+            "LastModified": obj["LastModified"]
+        } for page in pages for obj in page.get("Contents", []) if obj["Size"] > 0]
+
+    def _save_list_index(self, index_path, objects):
+        """
+        리스트 결과를 [Key, Size, LastModified] 배열로 줄여서 gz 압축한 인덱스 파일로 저장합니다.
+        """
+        index = {
+            "stored_time": time.time(),
+            "objects": [[obj["Key"], obj["Size"], obj["LastModified"].isoformat()] for obj in objects]
+        }
+        self._s3_client.put_object(Bucket=self.bucket_name, Key=index_path,
+                                   Body=gzip.compress(json.dumps(index).encode("utf-8")),
+                                   ContentType="application/json", ContentEncoding="gzip")
+
+    def _load_list_index(self, index_path, index_cache_ttl):
+        """
+        인덱스 파일이 없거나 index_cache_ttl 이 지났다면 None 을 돌려줍니다. 리스트 결과와 같은 형식으로 돌려줍니다.
+        """
+        try:
+            index = self._load_file(index_path)
+        except ClientError as e:
+            if not self._is_missing_key_error(e):
+                raise
+            return None
+
+        if time.time() - index["stored_time"] > index_cache_ttl:
+            return None
+
+        return [{
+            "Key": key,
+            "Size": size,
+            "LastModified": datetime.datetime.fromisoformat(last_modified)
+        } for key, size, last_modified in index["objects"]]
+
+    def _load_file(self, full_path):
+        """
+        gz, zstd 로 압축된 파일은 전체를 받아두지 않고 받으면서 압축을 풉니다.
+
+        * parquet 파일을 불러오려면 `fastparquet` 와 `pandas` 를 설치해야 합니다.
+        """
+        _, ext = _splitext_fast(full_path)
+
+        body = self._open_object(full_path)
+
+        if ext == ".parquet":
+            import pandas as pd
+            return pd.read_parquet(BytesIO(body.read()), engine="fastparquet")
+
+        if ext == ".gz":
+            stream = gzip.GzipFile(fileobj=body, mode="rb")
+        elif ext == ".zst":
+            import zstandard
+            stream = zstandard.ZstdDecompressor().stream_reader(body)
+        else:
+            return self._decode(body.read())
+
+        with stream:
+            return self._decode(stream.read())
+
+    def _open_object(self, full_path):
+        """
+        작은 파일은 응답 스트림을 그대로 돌려주고, 큰 파일은 범위를 나눠 동시에 받아서 돌려줍니다.
+
+        첫 요청을 범위 요청으로 보내서 HEAD 요청 없이 파일 크기를 알아냅니다.
+        """
+        s3_client = self._s3_client
+        try:
+            response = s3_client.get_object(Bucket=self.bucket_name, Key=full_path,
+                                            Range=f"bytes=0-{self._RANGED_GET_THRESHOLD - 1}")
+        except ClientError as e:
+            # 빈 파일은 범위 요청을 할 수 없습니다.
+            if e.response["Error"]["Code"] != "InvalidRange":
+                raise
+            return s3_client.get_object(Bucket=self.bucket_name, Key=full_path)["Body"]
+
+        if "ContentRange" not in response:
+            return response["Body"]
+
+        size = int(response["ContentRange"].rsplit("/", 1)[1])
+        if size <= self._RANGED_GET_THRESHOLD:
+            return response["Body"]
+
+        # 받는 중에 같은 키에 다시 저장되어도 다른 파일의 조각이 섞이지 않도록 첫 응답의 ETag 로 고정합니다.
+        etag = response["ETag"]
+
+        def get_range(start):
+            end = min(start + self._RANGED_GET_CHUNK, size) - 1
+            return s3_client.get_object(Bucket=self.bucket_name, Key=full_path, IfMatch=etag,
+                                        Range=f"bytes={start}-{end}")["Body"].read()
+
+        parts = self._get_range_executor().map(get_range, range(self._RANGED_GET_THRESHOLD, size, self._RANGED_GET_CHUNK))
+        first = response["Body"].read()
+
+        return BytesIO(b"".join([first, *parts]))
+
+    def _get_range_executor(self):
+        if self._range_executor == None:
+            with self._client_lock:
+                if self._range_executor == None:
+                    self._range_executor = ThreadPoolExecutor(max_workers=self._RANGED_GET_WORKERS)
+
+        return self._range_executor
+
+    def _decode(self, readed):
+        """
+        json, 문자열, 바이너리 순서로 해석합니다.
+        """
+        try:
+            encoded = readed.decode("utf-8")
+        except UnicodeDecodeError:
+            return readed
+
+        try:
+            return json.loads(encoded)
+        except ValueError:
+            return encoded
+
+    def _to_binary(self, value):
+        if isinstance(value, bytes):
+            return value
+
+        if isinstance(value, str):
+            return value.encode("utf-8")
+
+        return json.dumps(value, ensure_ascii=False, default=str).encode("utf-8")
+
+    def _to_parquet(self, value):
+        """
+        * parquet 로 저장하려면 `fastparquet` 와 `pandas` 를 설치해야 합니다.
+        """
+        import pandas as pd
+
+        if isinstance(value, dict):
+            value = [value]
+
+        if not isinstance(value, list):
+            raise ValueError(f"parquet value's instance must be list. value type is {type(value)}")
+
+        buffer = BytesIO()
+        pd.DataFrame(value).to_parquet(buffer, engine="fastparquet", compression="GZIP")
+
+        return buffer.getvalue()
+
+    def _compress(self, binary):
+        if self._compress_type == "gz1":
+            return gzip.compress(binary, compresslevel=1)
+
+        if self._compress_type == "zstd":
+            import zstandard
+            return zstandard.ZstdCompressor(level=3).compress(binary)
+
+        return gzip.compress(binary)
+
+    def _listdir(self, full_path):
+        """
+        Delimiter 로 바로 아래의 디렉토리만 S3 에서 받아옵니다. 하위의 파일을 모두 리스트하지 않습니다.
+        """
+        paginator = self._s3_client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(Bucket=self.bucket_name, Prefix=f"default/{self.warehouse_name}/{full_path}/",
+                                   Delimiter="/", PaginationConfig={"PageSize": 1000})
+
+        result = []
+        for page in pages:
+            result.extend(prefix["Prefix"].rstrip("/") for prefix in page.get("CommonPrefixes", []))
 
         return result
 
@@ -557,12 +883,8 @@ class DataWarehouse():
         랜덤으로 문자열을 생성해주는 함수입니다. 길이를 지정 할 수 있습니다.
         """        
         random_box = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890"
-        random_box_length = len(random_box)
-        result = ""
-        for _ in range(length):
-            result += random_box[int(random.random()*random_box_length)]
 
-        return result
+        return "".join(random.choices(random_box, k=length))
 
 
     def _json_to_csv(self, json_data):
@@ -573,54 +895,118 @@ class DataWarehouse():
         if not isinstance(json_data, list):
             raise ValueError("json data's type must be list.")
         line = StringIO()
-        writer = csv.writer(line)
 
         if len(json_data) > 0:
-            csv_rows = []
-            csv_rows.append(list(json_data[0].keys()))
-            for row in json_data:
-                csv_rows.append(row.values())
-            writer.writerows(csv_rows)
+            # 모든 행의 키를 나온 순서대로 헤더로 사용하고, 키 순서가 다른 행도 헤더에 맞춰 씁니다.
+            fieldnames = list(dict.fromkeys(key for row in json_data for key in row))
+            writer = csv.DictWriter(line, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(json_data)
             result = line.getvalue()
 
         return result
 
 
+    @property
+    def _s3_client(self):
+        """
+        S3 를 처음 사용 할 때 클라이언트를 만듭니다. 아테나만 사용한다면 만들지 않습니다.
+        """
+        if self._s3 == None:
+            with self._client_lock:
+                if self._s3 == None:
+                    self._s3 = self._create_client('s3')
+
+        return self._s3
+
     def _get_athena_client(self):
         if self._athena_client == None:
-            self._athena_client = boto3.client('athena',
-                                               aws_access_key_id=self._aws_access_key_id,
-                                               aws_secret_access_key=self._aws_secret_access_key,
-                                               region_name=self._region_name)
+            with self._client_lock:
+                if self._athena_client == None:
+                    self._athena_client = self._create_client('athena')
 
         return self._athena_client
 
+    def _create_client(self, service_name):
+        return _create_client(service_name,
+                              aws_access_key_id=self._aws_access_key_id,
+                              aws_secret_access_key=self._aws_secret_access_key,
+                              region_name=self._region_name,
+                              config=self._boto_config)
+
     def _get_table_name(self, table_name):
         return table_name if table_name else self.table_name
         
 
-    def _get_warehouse_full_path(self, store_kind, table_name, user_path, table_kind="general", ymd="", is_meta=False):
+    def _get_warehouse_full_path(self, store_kind, table_name, user_path, table_kind="general", ymd="", is_meta=False, add_ext=None):
+        prefix, suffix = self._get_warehouse_path_parts(store_kind, table_name, user_path, table_kind, ymd, add_ext)
+
+        if is_meta:
+            meta_or_value = "meta"
+        else:
+            meta_or_value = "value"
+
+        return f"{prefix}{meta_or_value}{suffix}"
+
+    def _get_warehouse_path_parts(self, store_kind, table_name, user_path, table_kind="general", ymd="", add_ext=None):
+        """
+        저장 경로를 meta 또는 value 가 들어갈 자리의 앞, 뒤로 나눠서 만들어줍니다. value 와 meta 경로를 한번에 만들 때 사용합니다.
+
+        add_ext 를 생략하면 compress_type 에 맞는 확장자를 붙입니다.
+        """
         table_name = self._get_table_name(table_name)
 
+        if store_kind not in ("raw", "discovery"):
+            raise ValueError(f"invalid store_kind {store_kind}")
+
         ymd_with_slash = ""
         if ymd != "":
             ymd_with_slash = "/" + ymd
 
-        if is_meta:
-            meta_or_value = "meta"
-        else:
-            meta_or_value = "value"
-        _, ext = os.path.splitext(user_path)
-        add_ext = ""
-        if ext != ".parquet":
-            add_ext = ".gz"
+        if add_ext == None:
+            add_ext = self._get_add_ext(user_path)
 
-        remaining_path = f"{table_kind}/{meta_or_value}/{table_name}{ymd_with_slash}/{user_path}{add_ext}"
-        if store_kind == "raw":
-            return f"raw/{remaining_path}"
+        prefix = self._make_valid_path(f"{store_kind}/{table_kind}/")
+        suffix = self._make_valid_path(f"{table_name}{ymd_with_slash}/{user_path}{add_ext}")
+
+        return prefix, f"/{suffix}"
+
+    def _make_valid_path(self, path):
+        """
+        이전 버전에서 저장한 키와 같아지도록 EasyS3 와 같은 방식으로 경로를 정리합니다.
+        """
+        path = path.replace("\\", "/")
+        path = path.replace("//", "/")
 
-        if store_kind == "discovery":
-            return f"discovery/{remaining_path}"
+        if path[:1] == "/":
+            path = path[1:]
+
+        return path
+
+    def _is_missing_key_error(self, error):
+        """
+        s3:ListBucket 권한이 없으면 S3 는 없는 키에 NoSuchKey 대신 AccessDenied(403) 를 돌려주므로 둘 다 없는 키로 봅니다.
+        """
+        return error.response["Error"]["Code"] in ("NoSuchKey", "404", "AccessDenied", "403")
+
+    def _get_add_ext(self, user_path):
+        _, ext = _splitext_fast(user_path)
+        if ext.lower() in self._INCOMPRESSIBLE_EXTS:
+            return ""
+
+        return self._COMPRESS_EXTS[self._compress_type]
+
+    def _get_load_exts(self, user_path):
+        """
+        불러올 때 차례대로 시도할 압축 확장자입니다. compress_type 의 확장자를 먼저 시도하고 나머지 압축 확장자를 시도합니다.
+
+        이미 압축된 확장자도 예전에는 .gz 를 붙여 저장했으므로 .gz 를 시도합니다.
+        """
+        add_ext = self._get_add_ext(user_path)
+        if add_ext == "":
+            return ["", ".gz"]
+
+        return list(dict.fromkeys([add_ext, *self._COMPRESS_EXTS.values()]))
 
     def _get_valid_user_path(self, user_path):
 
@@ -641,84 +1027,97 @@ class DataWarehouse():
             result = user_path
         return result
 
-    def _upgrade_meta(self, store_kind, meta, warehouse_full_path, table_name):
-        table_name = self._get_table_name(table_name)
-
-        temp_meta = meta.copy()
-        new_meta = {}
-        new_meta.update({
-            "default_table_name": table_name
-        })
-        full_path = f"default/{self.warehouse_name}/{warehouse_full_path}"
-        # parsed = self._parse_full_path(full_path)
-
-        temp_meta["full_path"] = full_path
-        # temp_meta["uuid"] = parsed.uuid
-        temp_meta["stored_time"] = str(datetime.datetime.now())
-        # temp_meta["time_ns"] = parsed.time_ns
-        temp_meta["ymd"] = datetime.datetime.now().strftime("%Y-%m-%d")
-
-        if store_kind == "raw":
-            pass
-        elif store_kind == "discovery":
-            pass
-        else:
+    def _upgrade_meta(self, store_kind, meta, warehouse_full_path, table_name, now, ymd_str):
+        if store_kind not in ("raw", "discovery"):
             raise ValueError(f"invalid store_kind {store_kind}")
 
-        for key in temp_meta:
-            value = temp_meta[key]
-            new_meta[f"{store_kind}_{key}"] = value
-
-        return new_meta
+        full_path = f"default/{self.warehouse_name}/{warehouse_full_path}"
 
-    def _valid_full_path(self, full_path):
-        if not full_path.startswith(f"default/{self.warehouse_name}/"):
-            raise ValueError(f"invalid full_path {full_path}")
+        # 사용자 메타데이터도 저장된 형식(store_kind_ 접두사)을 유지하고, 기본 메타데이터가 같은 키를 덮어씁니다.
+        return {
+            "default_table_name": self._get_table_name(table_name),
+            **{f"{store_kind}_{key}": value for key, value in meta.items()},
+            f"{store_kind}_full_path": full_path,
+            f"{store_kind}_stored_time": str(now),
+            f"{store_kind}_ymd": ymd_str,
+        }
 
     # SAVE
     def _save_worker(self, store_kind, table_kind, user_path, value, meta, use_ymd, table_name, user_ymd):
         result = ""
 
         ymd = ""
+        now = datetime.datetime.now()
+        today = now.strftime("%Y-%m-%d")
         table_name = self._get_table_name(table_name)
         if user_ymd != "":
             ymd = user_ymd
         elif use_ymd:
-            ymd = datetime.datetime.now().strftime("%Y-%m-%d")
+            ymd = today
 
         user_path = self._get_valid_user_path(user_path)
-        _, ext = os.path.splitext(user_path)
+        _, ext = _splitext_fast(user_path)
 
             
         if ext == ".csv" and isinstance(value, list):
             value = self._json_to_csv(value)
 
-        warehouse_full_path = self._get_warehouse_full_path(store_kind, table_name, user_path,
-                                                  table_kind=table_kind, ymd=ymd, is_meta=False)
-
-        meta_warehouse_full_path = self._get_warehouse_full_path(store_kind, table_name, user_path,
-                                                       table_kind=table_kind, ymd=ymd, is_meta=True)
+        prefix, suffix = self._get_warehouse_path_parts(store_kind, table_name, user_path,
+                                                        table_kind=table_kind, ymd=ymd)
+        warehouse_full_path = f"{prefix}value{suffix}"
+        meta_warehouse_full_path = f"{prefix}meta{suffix}"
         
-        meta = self._upgrade_meta(store_kind, meta, warehouse_full_path, table_name)
+        meta = self._upgrade_meta(store_kind, meta, warehouse_full_path, table_name, now, today)
 
-        option = {}
-        if ext != ".parquet":
-            option = {
-                "compress_type": "gz"
-            }
+        compress = ext.lower() not in self._INCOMPRESSIBLE_EXTS
 
+        # meta 는 value 와 같은 확장자로 저장되지만 parquet 가 아니라면 항상 json 입니다.
+        meta_content_type = None
+        if ext != ".parquet":
+            meta_content_type = "application/json"
 
         if store_kind == "raw":
-            self._es_handler.save(meta_warehouse_full_path, meta, option)
+            # raw_list(load=True, is_meta=True) 는 value 를 리스트하고 meta 를 불러오므로 meta 를 먼저 저장해야 합니다.
+            self._put_object(meta_warehouse_full_path, meta, compress, meta_content_type)
 
-            result = self._es_handler.save(warehouse_full_path, value, option)
+            result = self._put_object(warehouse_full_path, value, compress)
 
-        elif store_kind == "discovery":
+        else:
+            # discovery 는 원래 value 를 먼저 저장해서 meta 가 늦게 보이므로, 순서에 기대는 곳이 없어 동시에 저장합니다.
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                value_future = executor.submit(self._put_object, warehouse_full_path, value, compress)
+                meta_future = executor.submit(self._put_object, meta_warehouse_full_path, meta, compress, meta_content_type)
 
-            result = self._es_handler.save(warehouse_full_path, value, option)
+                result = value_future.result()
+                meta_future.result()
 
-            self._es_handler.save(meta_warehouse_full_path, meta, option)                
-        else:
-            raise ValueError(f"invalid store kind {store_kind}")
+        self._invalidate_list_cache(warehouse_full_path)
 
         return result
+
+    def _put_object(self, warehouse_full_path, value, compress, content_type=None):
+        full_path = f"default/{self.warehouse_name}/{warehouse_full_path}"
+
+        options = {}
+        original_path = full_path
+        _, ext = _splitext_fast(full_path)
+        if ext == ".parquet":
+            binary = self._to_parquet(value)
+        else:
+            binary = self._to_binary(value)
+            if compress:
+                binary = self._compress(binary)
+
+                # 내려받을 때 압축이 풀리도록 Content-Encoding 을 넣고, Content-Type 은 압축 전 파일 기준으로 정합니다.
+                options["ContentEncoding"] = self._CONTENT_ENCODINGS[self._compress_type]
+                original_path = full_path[:-len(self._COMPRESS_EXTS[self._compress_type])]
+
+        if content_type == None:
+            content_type, _ = mimetypes.guess_type(original_path)
+        if content_type == None:
+            content_type = "binary/octet-stream"
+
+        self._s3_client.put_object(Bucket=self.bucket_name, Key=full_path,
+                                   Body=binary, ContentType=content_type, **options)
+
+        return f"https://{self.bucket_name}.s3.{self._region_name}.amazonaws.com/{full_path}"